@@ -8,7 +8,10 @@ import os, re, json, base64
 import importlib
 import subprocess
 import sys
+import threading
+import time
 from io import BytesIO
+from contextlib import contextmanager
 from datetime import datetime
 
 import streamlit as st
@@ -372,34 +375,69 @@ HERO_HTML = r"""
     const pad=12;
     svg.setAttribute('viewBox',`${minx-pad} ${miny-pad} ${(maxx-minx)+2*pad} ${(maxy-miny)+2*pad}`);
   })();
-  let t0=performance.now();
-  function frame(t){
-    const theta=((t-t0)/1000)*SPEED;
-    render(theta);
-    requestAnimationFrame(frame);
-  }
-  requestAnimationFrame(frame);
-  function render(theta){
-    const ordered=[];
-    for(const f of facelets){
-      let depth=0;
-      const pts2d=[];
+  // Precompute one revolution as keyframes (points strings + back-to-front order)
+  // so the running loop does no trig, no sorting and no string building.
+  const KEYFRAMES=240, FPS_CAP=24, FRAME_MS=1000/FPS_CAP, PERIOD_MS=((2*Math.PI)/SPEED)*1000;
+  const frames=[];
+  for(let k=0;k<KEYFRAMES;k++){
+    const theta=(k/KEYFRAMES)*Math.PI*2;
+    const pts=new Array(facelets.length), depth=new Array(facelets.length);
+    facelets.forEach((f,i)=>{
       const o=LAYER_SHIFT[f.layer];
+      let d=0;
+      const pts2d=[];
       for(const p of f.quad){
         const q=[p[0]+o[0],p[1]+o[1],p[2]+o[2]];
         const r=rotX(rotY(q,theta),PITCH);
-        depth+=r[0]+r[1]+r[2];
+        d+=r[0]+r[1]+r[2];
         const [X,Y]=project(...r);
-        pts2d.push([X,Y]);
+        pts2d.push(`${X.toFixed(2)},${Y.toFixed(2)}`);
       }
-      ordered.push({el:f.el,depth,pts2d});
-    }
-    ordered.sort((a,b)=>a.depth-b.depth);
-    ordered.forEach(o=>{
-      o.el.setAttribute('points', o.pts2d.map(([x,y])=>`${x},${y}`).join(' '));
-      g.appendChild(o.el);
+      pts[i]=pts2d.join(' ');
+      depth[i]=d;
     });
+    const order=facelets.map((_,i)=>i).sort((a,b)=>depth[a]-depth[b]);
+    frames.push({pts,order});
+  }
+  let shown=-1;
+  function apply(k){
+    if(k===shown) return;
+    const fr=frames[k];
+    for(let i=0;i<facelets.length;i++) facelets[i].el.setAttribute('points', fr.pts[i]);
+    // Only move elements whose depth rank changed; unchanged order costs no DOM writes.
+    const kids=g.childNodes;
+    for(let r=0;r<fr.order.length;r++){
+      const el=facelets[fr.order[r]].el;
+      if(kids[r]!==el) g.insertBefore(el, kids[r]);
+    }
+    shown=k;
+  }
+  // Run only while visible, on-screen and motion is allowed; capped at FPS_CAP.
+  const reduceMotion=window.matchMedia ? window.matchMedia('(prefers-reduced-motion: reduce)') : null;
+  let raf=0, last=0, phase=0, onScreen=true;
+  function tick(t){
+    raf=requestAnimationFrame(tick);
+    const dt=t-last;
+    if(dt<FRAME_MS) return;
+    last=t;
+    phase=(phase+Math.min(dt,250))%PERIOD_MS;
+    apply(Math.floor((phase/PERIOD_MS)*KEYFRAMES)%KEYFRAMES);
+  }
+  function sync(){
+    const run=!document.hidden && onScreen && !(reduceMotion && reduceMotion.matches);
+    if(run && !raf){ last=performance.now(); raf=requestAnimationFrame(tick); }
+    else if(!run && raf){ cancelAnimationFrame(raf); raf=0; }
+  }
+  document.addEventListener('visibilitychange', sync);
+  if('IntersectionObserver' in window){
+    new IntersectionObserver(es=>{ onScreen=es[es.length-1].isIntersecting; sync(); }).observe(svg);
   }
+  if(reduceMotion){
+    if(reduceMotion.addEventListener) reduceMotion.addEventListener('change', sync);
+    else if(reduceMotion.addListener) reduceMotion.addListener(sync);
+  }
+  apply(0);
+  sync();
 })();
 </script>
 """
@@ -456,7 +494,10 @@ if page == "home":
             <div class="btnTitle">Deal Document Parsing</div>
             <div class="btnText tiny">Extract structured data from deal documents in a ready-to-use format.</div>
           </a>
-          <a class="swatch" href="?page=sample3" target="_self"><div class="btnTitle">Sample 3</div><div class="btnText tiny">Button subtext</div></a>
+          <a class="swatch" href="?page=history" target="_self">
+            <div class="btnTitle">Holdings History</div>
+            <div class="btnText tiny">Look up any ISIN across every reconciled statement, by date range or source file.</div>
+          </a>
           <a class="swatch" href="?page=sample4" target="_self"><div class="btnTitle">Sample 4</div><div class="btnText tiny">Button subtext</div></a>
           <a class="swatch" href="?page=sample5" target="_self"><div class="btnTitle">Sample 5</div><div class="btnText tiny">Button subtext</div></a>
         </div>
@@ -584,12 +625,361 @@ def parse_single_row_fallback(row_text: str):
             rec["status"] = nxt if nxt else c
     return rec
 
+# Row validation: gates LLM calls ("deterministic first" mode) and model escalation.
+VALUE_REL_TOLERANCE = 0.01  # balance × market_rate vs market_value
+VALUE_ABS_TOLERANCE = 1.0   # absorbs rounding on small holdings
+
+def isin_check_digit_ok(isin: str) -> bool:
+    isin = str(isin or "")
+    if not re.fullmatch(r"[A-Z]{2}[A-Z0-9]{9}\d", isin):
+        return False
+    digits = "".join(str(int(c, 36)) for c in isin[:-1])
+    total = 0
+    for i, c in enumerate(reversed(digits)):
+        d = int(c)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return (10 - total % 10) % 10 == int(isin[-1])
+
+def _values_agree(expected: float, actual: float) -> bool:
+    return abs(expected - actual) <= max(VALUE_ABS_TOLERANCE, VALUE_REL_TOLERANCE * abs(actual))
+
+def validate_row(r: dict, row_text: str | None = None, *, require_amounts: bool = False):
+    """Return a list of problems with an extracted row; empty means it looks sound.
+
+    With ``require_amounts`` balance, market_rate and market_value must all be
+    present (and hence numeric and consistent), as needed to skip the LLM.
+    """
+    problems = []
+    isin = r.get("isin")
+    if not isin or not re.fullmatch(r"[A-Z]{2}[A-Z0-9]{9}\d", str(isin)):
+        problems.append("isin_format")
+    elif not isin_check_digit_ok(isin):
+        problems.append("isin_check_digit")
+    elif row_text and _find_isin_in_text(row_text) not in (None, isin):
+        problems.append("isin_mismatch")
+    nums = {}
+    for k in ("balance", "market_rate", "market_value"):
+        if r.get(k) not in (None, ""):
+            nums[k] = _to_number(r.get(k))
+            if nums[k] is None:
+                problems.append(f"{k}_not_numeric")
+        elif require_amounts:
+            problems.append(f"{k}_missing")
+    if _to_number(r.get("value")) is None:
+        problems.append("value_missing")
+    bal, rate, mv = nums.get("balance"), nums.get("market_rate"), nums.get("market_value")
+    if None not in (bal, rate, mv) and not _values_agree(bal * rate, mv):
+        problems.append("value_mismatch")
+    return problems
+
+def parse_row_deterministic(row_text: str):
+    """parse_single_row_fallback, plus positional numbers for unlabeled table rows.
+
+    When the cells carry no balance/rate/value labels, the first run of three
+    numeric cells after the ISIN satisfying balance × rate ≈ value is used.
+    """
+    rec = parse_single_row_fallback(row_text)
+    if all(rec.get(k) is not None for k in ("balance", "market_rate", "market_value")):
+        return rec
+    cells = [c.strip() for c in row_text.split("|")]
+    start = next((i for i, c in enumerate(cells) if rec["isin"] and rec["isin"] in c.replace(" ", "")), 0)
+    nums = [
+        _to_number(c) for c in cells[start + 1:]
+        if re.fullmatch(r"\(?[₹$]?\s*[\d,]+(?:\.\d+)?\)?", c)
+    ]
+    for a, b, c in zip(nums, nums[1:], nums[2:]):
+        if None not in (a, b, c) and a and b and _values_agree(a * b, c):
+            for k, v in (("balance", a), ("market_rate", b), ("market_value", c)):
+                if rec.get(k) is None:
+                    rec[k] = v
+            break
+    return rec
+
+# Conservative 'missed row' assist: spot likely gaps after the first pass,
+# then re-run only the affected page (higher render scale) or line range (LLM).
+ASSIST_RESCAN_SCALE = 3.0
+ASSIST_MAX_SR_JUMP = 5  # larger jumps between serial numbers are not treated as missed rows
+
+def _find_all_isins_in_text(text: str):
+    return re.findall(r"\bIN[A-Z0-9]{10}\b", str(text).upper())
+
+def serial_sr_nos(chunks):
+    """The page's sr_nos, or [] when they don't look like a serial column.
+
+    The first integer cell is a quantity on tables without a serial column, so
+    the numbers are only trusted when consecutive rows mostly step by one.
+    """
+    sr_nos = [ch["sr_no"] for ch in chunks if ch.get("sr_no") is not None]
+    if len(sr_nos) < 2:
+        return sr_nos
+    steps = [b - a for a, b in zip(sr_nos, sr_nos[1:])]
+    if any(d <= 0 for d in steps) or 2 * sum(d == 1 for d in steps) < len(steps):
+        return []
+    return sr_nos
+
+def find_missed_row_hints(md_text: str, chunks, prev_sr_no=None):
+    """Return (sr_gaps, orphan_isins) for one page of OCR markdown.
+
+    sr_gaps are serial numbers missing from the page's sequence (including the
+    jump from the previous page's last sr_no); orphan_isins are ISIN tokens in
+    the markdown that did not produce a row chunk.
+    """
+    sr_nos = sorted(set(serial_sr_nos(chunks)))
+    sr_gaps = []
+    if sr_nos and prev_sr_no is not None and 1 < sr_nos[0] - prev_sr_no <= ASSIST_MAX_SR_JUMP:
+        sr_gaps.extend(range(prev_sr_no + 1, sr_nos[0]))
+    for a, b in zip(sr_nos, sr_nos[1:]):
+        if b - a <= ASSIST_MAX_SR_JUMP:
+            sr_gaps.extend(range(a + 1, b))
+    known = {_find_isin_in_text(ch["row_text"]) for ch in chunks}
+    orphan_isins = []
+    for isin in _find_all_isins_in_text(md_text):
+        if isin not in known and isin not in orphan_isins:
+            orphan_isins.append(isin)
+    return sr_gaps, orphan_isins
+
+def _isin_line_window(md_text: str, isin: str, context: int = 1):
+    lines = [ln.strip() for ln in str(md_text).splitlines() if ln and ln.strip()]
+    for i, ln in enumerate(lines):
+        if isin in ln.upper():
+            return " | ".join(lines[max(0, i - context): i + context + 1])
+    return None
+
+EXTRACTION_MODES = {
+    "LLM first": "llm_first",
+    "Deterministic first, LLM only on validation failure": "validate_first",
+}
+
+def extract_row_from_chunk(ch: dict, span_tag: str, model: str, openai_key: str, *,
+                           mode: str = "llm_first", routing: str = "fixed", ledger=None, source=None) -> dict:
+    """Extract one row from a chunk via LangExtract, falling back to deterministic parsing.
+
+    With ``mode="validate_first"`` the chunk is parsed deterministically first
+    and the LLM is only called when that row fails validate_row (amounts
+    required); if the LLM then yields nothing, the deterministic row is kept. With
+    ``routing="cheapest_first"`` the ROUTING_LADDER is walked from the cheapest
+    model up, escalating only while the result fails validate_row. No LLM call
+    is made once the ledger's budget is exhausted. ``extraction_path`` on the
+    row records which path produced it: deterministic, llm or fallback.
+    """
+    deterministic = None
+    if mode == "validate_first":
+        deterministic = canonicalize_row(parse_row_deterministic(ch["row_text"]))
+        if not validate_row(deterministic, ch["row_text"], require_amounts=True):
+            deterministic["extraction_path"] = "deterministic"
+            deterministic["sr_no"] = ch.get("sr_no")
+            return deterministic
+
+    ladder = ROUTING_LADDER if routing == "cheapest_first" else [model]
+    r = None
+    for m in ladder:
+        if ledger is not None and ledger.exhausted():
+            break
+        recs = extract_records_with_langextract(
+            span_tag, m, openai_key=openai_key,
+            fallbacks=routing != "cheapest_first", ledger=ledger, source=source,
+        )
+        if len(recs) != 1:
+            continue
+        r = canonicalize_row(recs[0])
+        r["extraction_path"] = "llm"
+        if routing != "cheapest_first" or not validate_row(r, ch["row_text"]):
+            break
+    if r is None:
+        # In validate_first mode keep the richer deterministic row already built.
+        r = deterministic if deterministic is not None else canonicalize_row(parse_single_row_fallback(ch["row_text"]))
+        r["extraction_path"] = "fallback"
+    r["sr_no"] = ch.get("sr_no")
+    return r
+
+def missed_row_assist(md_text: str, chunks, *, span_prefix: str, model: str, openai_key: str,
+                      rescan=None, prev_sr_no=None, rescan_prev=None, prev_span_prefix=None,
+                      mode: str = "llm_first", routing: str = "fixed", ledger=None, source=None):
+    """Second pass for one page; returns only rows that fill a detected gap.
+
+    ``rescan`` is an optional callable returning fresh OCR markdown for the page
+    (e.g. re-rendered at a higher scale); it is only invoked when the sr_no
+    sequence has gaps. A rescan chunk is accepted only if its sr_no is one of
+    the gaps, or it has no sr_no and an ISIN not seen on the page. A leading
+    gap (between the previous page's last sr_no and this page's first) may sit
+    at the bottom of the previous page, so whatever the current-page rescan
+    doesn't recover is looked for via ``rescan_prev``; those rows are tagged
+    ``assist="rescan_prev"`` for the caller to attribute to the previous page.
+    """
+    sr_gaps, orphan_isins = find_missed_row_hints(md_text, chunks, prev_sr_no)
+    if not sr_gaps and not orphan_isins:
+        return []
+
+    known = {_find_isin_in_text(ch["row_text"]) for ch in chunks}
+    page_sr_nos = serial_sr_nos(chunks)
+    first_sr = min(page_sr_nos) if page_sr_nos else None
+    leading = {g for g in sr_gaps if first_sr is not None and g < first_sr}
+    wanted = set(sr_gaps)
+    rows = []
+
+    def take(md, prefix, tag, accept_unnumbered):
+        for ch in segment_rows_by_isin(md):
+            isin = _find_isin_in_text(ch["row_text"])
+            if isin in known:
+                continue
+            sr = ch.get("sr_no")
+            if sr is None and not accept_unnumbered:
+                continue
+            if sr is not None and sr not in wanted:
+                continue
+            r = extract_row_from_chunk(
+                ch, f"{prefix} | {ch['row_text']}", model, openai_key,
+                mode=mode, routing=routing, ledger=ledger, source=source,
+            )
+            r["assist"] = tag
+            rows.append(r)
+            known.add(isin)
+            wanted.discard(sr)
+
+    if sr_gaps and rescan is not None:
+        take(rescan() or "", span_prefix, "rescan", accept_unnumbered=True)
+    if leading & wanted and rescan_prev is not None:
+        wanted &= leading
+        take(rescan_prev() or "", prev_span_prefix or span_prefix, "rescan_prev", accept_unnumbered=False)
+
+    for isin in orphan_isins:
+        if isin in known or (ledger is not None and ledger.exhausted()):
+            continue
+        window = _isin_line_window(md_text, isin)
+        if not window:
+            continue
+        recs = extract_records_with_langextract(
+            f"{span_prefix} | {window}", model, openai_key=openai_key, ledger=ledger, source=source,
+        )
+        for rec in recs:
+            r = canonicalize_row(rec)
+            if r.get("isin") == isin:
+                r["extraction_path"] = "llm"
+                r["sr_no"] = None
+                r["assist"] = "line_llm"
+                rows.append(r)
+                known.add(isin)
+                break
+    return rows
+
 # OCR: mistral
 def encode_image_bytes_to_data_url(b: bytes, mime_hint: str) -> str:
     b64 = base64.b64encode(b).decode("utf-8")
     return f"data:{mime_hint};base64,{b64}"
 
-def run_mistral_ocr_on_image_bytes(mistral_client, b: bytes, mime_hint: str = "image/jpeg") -> str:
+# OCR payload minimization: trim margins, drop colour, cap resolution and pick the
+# smallest encoding before the page is base64'd into a data URL.
+OCR_MAX_EDGE = 2000          # px, long edge
+OCR_TRIM_THRESHOLD = 232     # grey level below which a pixel counts as ink
+OCR_TRIM_PAD = 16            # px kept around the inked area
+OCR_BILEVEL_THRESHOLD = 160  # grey level at or above which a pixel becomes white
+OCR_JPEG_QUALITY = 80
+OCR_WEBP_QUALITY = 80
+OCR_COMPACT_MODES = {
+    "Grayscale (recommended)": "gray",
+    "Bilevel (smallest)": "bilevel",
+    "Off (full-colour PNG)": None,
+}
+
+def _encode_image(img, fmt: str) -> bytes:
+    buf = BytesIO()
+    if fmt == "PNG":
+        img.save(buf, format="PNG", optimize=True)
+    elif fmt == "JPEG":
+        img.save(buf, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    else:
+        img.save(buf, format=fmt, quality=OCR_WEBP_QUALITY, method=4)
+    return buf.getvalue()
+
+def _estimate_png_bytes(img, strip: int = 64, every: int = 8) -> int:
+    """Approximate PNG size from every ``every``-th band of ``strip`` rows, scaled to the full height."""
+    sampled = rows = 0
+    step = strip * every if img.height > strip * every else img.height
+    for top in range(0, img.height, step):
+        band = img.crop((0, top, img.width, min(img.height, top + strip)))
+        buf = BytesIO()
+        band.save(buf, format="PNG")
+        sampled += buf.tell()
+        rows += band.height
+    return int(sampled * img.height / rows)
+
+def prepare_image_for_ocr(img_or_bytes, *, compact: str | None = "gray", max_edge: int | None = OCR_MAX_EDGE,
+                          mime_hint: str = "image/png"):
+    """Return (bytes, mime, stats) for an OCR upload.
+
+    ``img_or_bytes`` is a PIL image (rendered PDF page) or uploaded file bytes.
+    With ``compact`` of "gray" or "bilevel" the image is trimmed to its inked
+    area, converted, capped at ``max_edge`` and encoded as the smallest of
+    PNG/JPEG/WebP (JPEG is skipped for bilevel). ``stats`` reports
+    ``bytes_before`` (what would have been sent uncompacted; for a compacted
+    rendered page this is estimated from sampled strips rather than paying a
+    second full encode), ``bytes_after``, ``format`` and the final ``size``.
+    """
+    from PIL import Image, ImageOps, features
+
+    if isinstance(img_or_bytes, (bytes, bytearray)):
+        before = bytes(img_or_bytes)
+        img = None
+    else:
+        img = img_or_bytes
+        mime_hint = "image/png"
+
+    if compact is None:
+        if img is not None:
+            buf = BytesIO()
+            img.save(buf, format="PNG")  # the uncompacted upload
+            before = buf.getvalue()
+        stats = {
+            "bytes_before": len(before), "bytes_after": len(before),
+            "format": mime_hint.split("/")[-1].upper(), "size": img.size if img is not None else None,
+        }
+        return before, mime_hint, stats
+
+    if img is None:
+        img = Image.open(BytesIO(before))
+        img.load()
+        n_before = len(before)
+    else:
+        n_before = _estimate_png_bytes(img)
+
+    gray = ImageOps.exif_transpose(img).convert("L")
+    bbox = gray.point(lambda p: 255 if p < OCR_TRIM_THRESHOLD else 0).getbbox()
+    if bbox:
+        l, t, r, b = bbox
+        gray = gray.crop((
+            max(0, l - OCR_TRIM_PAD), max(0, t - OCR_TRIM_PAD),
+            min(gray.width, r + OCR_TRIM_PAD), min(gray.height, b + OCR_TRIM_PAD),
+        ))
+    if max_edge and max(gray.size) > max_edge:
+        gray.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if compact == "bilevel":
+        out_img = gray.point(lambda p: 255 if p >= OCR_BILEVEL_THRESHOLD else 0).convert("1")
+        # PNG only: lossy JPEG/WebP would turn the thresholded page back into grey fringes.
+        formats = ["PNG"]
+    else:
+        out_img = gray
+        formats = ["PNG", "JPEG"]
+        if features.check("webp"):
+            formats.append("WEBP")
+
+    best_fmt, best = None, None
+    for fmt in formats:
+        try:
+            data = _encode_image(out_img, fmt)
+        except Exception:
+            continue
+        if best is None or len(data) < len(best):
+            best_fmt, best = fmt, data
+    stats = {"bytes_before": n_before, "bytes_after": len(best), "format": best_fmt, "size": out_img.size}
+    return best, f"image/{best_fmt.lower()}", stats
+
+def run_mistral_ocr_on_image_bytes(mistral_client, b: bytes, mime_hint: str = "image/jpeg", *,
+                                   on_error=show_popup_error) -> str:
     try:
         data_url = encode_image_bytes_to_data_url(b, mime_hint=mime_hint)
         resp = mistral_client.ocr.process(
@@ -605,9 +995,76 @@ def run_mistral_ocr_on_image_bytes(mistral_client, b: bytes, mime_hint: str = "i
                 md_chunks.append(md)
         return "\n\n".join(md_chunks).strip()
     except Exception as e:
-        show_popup_error(f"OCR failed: {e}")
+        on_error(f"OCR failed: {e}")
         return ""
 
+# LLM usage accounting. OpenAI list prices in USD per 1M tokens (input, output);
+# token counts are estimated from text length, so costs are approximate.
+MODEL_PRICING_PER_MTOK = {
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+}
+# Cheapest-first escalation order for budget-aware routing.
+ROUTING_LADDER = ["openai:gpt-5-nano", "openai:gpt-5-mini", "openai:gpt-4.1-mini"]
+ROUTING_MODES = {
+    "Fixed (selected model)": "fixed",
+    "Cheapest first, escalate on validation failure": "cheapest_first",
+}
+
+def model_family(model_id: str) -> str:
+    m = str(model_id).split(":", 1)[-1]
+    return re.sub(r"-\d{4}-\d{2}-\d{2}$", "", m)
+
+def estimate_tokens(text) -> int:
+    return max(1, math.ceil(len(str(text)) / 4))
+
+def llm_call_cost(model_id: str, tokens_in: int, tokens_out: int) -> float:
+    price_in, price_out = MODEL_PRICING_PER_MTOK.get(model_family(model_id), (0.0, 0.0))
+    return (tokens_in * price_in + tokens_out * price_out) / 1e6
+
+class UsageLedger:
+    """Thread-safe record of a run's LLM calls, with an optional USD budget cap."""
+
+    def __init__(self, budget_usd: float | None = None):
+        self.budget_usd = budget_usd or None
+        self.spent_usd = 0.0
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def exhausted(self) -> bool:
+        return self.budget_usd is not None and self.spent_usd >= self.budget_usd
+
+    def record(self, *, model: str, source, tokens_in: int, tokens_out: int, latency_s: float,
+               ok: bool = True, estimated: bool = True):
+        """Log one LLM attempt; failed attempts are logged (and charged) too."""
+        cost = llm_call_cost(model, tokens_in, tokens_out)
+        with self._lock:
+            self.spent_usd += cost
+            self.calls.append({
+                "source": source, "model": model_family(model), "tokens_in": tokens_in,
+                "tokens_out": tokens_out, "latency_s": latency_s, "cost_usd": cost,
+                "ok": ok, "estimated": estimated,
+            })
+
+    def summary(self):
+        """Aggregate calls per (source file, model)."""
+        with self._lock:
+            calls = list(self.calls)
+        agg = {}
+        for c in calls:
+            a = agg.setdefault((c["source"], c["model"]), {
+                "source": c["source"], "model": c["model"], "calls": 0, "failed": 0, "tokens_in": 0,
+                "tokens_out": 0, "latency_s": 0.0, "cost_usd": 0.0,
+            })
+            a["calls"] += 1
+            a["failed"] += 0 if c["ok"] else 1
+            for k in ("tokens_in", "tokens_out", "latency_s", "cost_usd"):
+                a[k] += c[k]
+        for a in agg.values():
+            a["avg_latency_s"] = a["latency_s"] / a["calls"]
+        return list(agg.values())
+
 # LangExtract wrapper
 PROMPT = """
 You are an information-extraction system for Demat/CSGL statements.
@@ -617,18 +1074,19 @@ Do not invent values; omit fields if unknown. Output must be valid JSON (no mark
 """
 EXAMPLES = []
 
-def _attempt_extract(model_id: str, text: str, *, use_json_object: bool, openai_key: str):
+def _attempt_extract(model_id: str, text: str, *, use_json_object: bool, openai_key: str,
+                     prompt: str = PROMPT, examples=None, max_output_tokens: int = 600):
     import langextract as lx
     try:
-        lm_params = {"temperature": 0, "seed": 7, "max_output_tokens": 600}
+        lm_params = {"temperature": 0, "seed": 7, "max_output_tokens": max_output_tokens}
         fence = True
         if use_json_object:
             fence = False
             lm_params["response_format"] = {"type": "json_object"}
         res = lx.extract(
             text_or_documents=text,
-            prompt_description=PROMPT,
-            examples=EXAMPLES,
+            prompt_description=prompt,
+            examples=EXAMPLES if examples is None else examples,
             model_id=model_id,
             api_key=openai_key,
             fence_output=fence,
@@ -639,29 +1097,224 @@ def _attempt_extract(model_id: str, text: str, *, use_json_object: bool, openai_
     except Exception as e:
         return None, e
 
-def extract_records_with_langextract(text: str, model_choice: str, openai_key: str):
-    # Try preferred ID then sensible fallbacks
+def _usage_from_result(res):
+    """Best-effort (input, output) token usage reported on a LangExtract result, else None."""
+    usage = getattr(res, "usage", None)
+    if usage is None and isinstance(res, dict):
+        usage = res.get("usage")
+    if usage is None:
+        return None
+    get = usage.get if isinstance(usage, dict) else (lambda k: getattr(usage, k, None))
+    tin = get("input_tokens") or get("prompt_tokens")
+    tout = get("output_tokens") or get("completion_tokens")  # includes reasoning tokens
+    if tin is None or tout is None:
+        return None
+    return int(tin), int(tout)
+
+def _langextract_payload(text: str, model_choice: str, openai_key: str, *, fallbacks: bool = True,
+                         ledger=None, source=None, **extract_kw):
+    """Run LangExtract with the preferred model (then sensible fallbacks); plain-dict payload or None.
+
+    Every attempt, failed or not, is recorded on ``ledger`` when one is given,
+    using the usage reported on the result if any. Otherwise output is charged
+    at ``max_output_tokens``, which bounds gpt-5 reasoning tokens, so budgets
+    err high. The chain stops once the ledger's budget is exhausted. The
+    payload's ``_model_id`` names the model that actually answered.
+    """
     prefs = [model_choice]
     if ":" not in model_choice:
         prefs.append(f"openai:{model_choice}")
-    prefs += ["openai:gpt-5-nano", "gpt-5-nano", "openai:gpt-5-mini", "gpt-5-mini", "openai:gpt-4.1-mini", "gpt-4.1-mini"]
+    if fallbacks:
+        prefs += ["openai:gpt-5-nano", "gpt-5-nano", "openai:gpt-5-mini", "gpt-5-mini", "openai:gpt-4.1-mini", "gpt-4.1-mini"]
+    est_in = estimate_tokens(extract_kw.get("prompt", PROMPT)) + estimate_tokens(text)
+    est_out = extract_kw.get("max_output_tokens", 600)
+
+    def attempt(mid, use_json_object):
+        t0 = time.perf_counter()
+        res, err = _attempt_extract(mid, text, use_json_object=use_json_object, openai_key=openai_key, **extract_kw)
+        if ledger is not None:
+            usage = _usage_from_result(res) if res is not None else None
+            tin, tout = usage or (est_in, est_out)
+            ledger.record(
+                model=mid, source=source, tokens_in=tin, tokens_out=tout,
+                latency_s=time.perf_counter() - t0, ok=res is not None, estimated=usage is None,
+            )
+        return res
+
     for mid in prefs:
-        res, err = _attempt_extract(mid, text, use_json_object=True, openai_key=openai_key)
-        if res is None:
-            res, err = _attempt_extract(mid, text, use_json_object=False, openai_key=openai_key)
-        if res is not None:
+        for use_json_object in (True, False):
+            if ledger is not None and ledger.exhausted():
+                return None
+            res = attempt(mid, use_json_object)
+            if res is None:
+                continue
             try:
                 payload = json.loads(json.dumps(res))  # cast to plain dict
-                rows = []
-                for ext in payload.get("extractions", []):
-                    if ext.get("extraction_class") == "record":
-                        attrs = ext.get("attributes", {}) or {}
-                        attrs["_span"] = ext.get("extraction_text", "")
-                        rows.append(attrs)
-                return rows
             except Exception:
-                return []
-    return []
+                return None
+            payload["_model_id"] = mid
+            return payload
+    return None
+
+def extract_records_with_langextract(text: str, model_choice: str, openai_key: str, **payload_kw):
+    payload = _langextract_payload(text, model_choice, openai_key, **payload_kw)
+    if not payload:
+        return []
+    rows = []
+    for ext in payload.get("extractions", []):
+        if ext.get("extraction_class") == "record":
+            attrs = ext.get("attributes", {}) or {}
+            attrs["_span"] = ext.get("extraction_text", "")
+            attrs["llm_model"] = payload.get("_model_id")
+            rows.append(attrs)
+    return rows
+
+# Deal documents: section-aware chunking + parallel per-chunk extraction + reduce
+DEAL_PROMPT = """
+You are an information-extraction system for deal documents (term sheets, agreements, offering documents).
+From the excerpt, extract only these fields if they are explicitly stated: {fields}.
+Use the field name as the extraction class and the exact wording from the excerpt as the extraction text.
+Do not invent values; omit fields that are not present. Output must be valid JSON (no markdown fences).
+"""
+DEAL_EXAMPLES = []
+DEAL_DEFAULT_FIELDS = [
+    "issuer", "instrument_type", "issue_size", "face_value", "coupon_rate",
+    "issue_date", "maturity_date", "security_collateral", "trustee", "arranger", "governing_law",
+]
+DEAL_CHUNK_CHARS = 12000
+DEAL_MAX_WORKERS = 4
+
+_MD_HEADING_RE = re.compile(r"^#{1,6}\s+\S")
+_KEYWORD_HEADING_RE = re.compile(r"^(?:article|section|clause|schedule|annex(?:ure)?|appendix|part)\s+[\dIVXLC]+\b", re.I)
+_NUMBERED_HEADING_RE = re.compile(r"^\d+(?:\.\d+)*\.?\s+[A-Z][A-Za-z ,&/()'-]{2,80}$")
+
+def _is_section_heading(line: str) -> bool:
+    ln = line.strip().strip("*").strip()
+    if not ln or len(ln) > 120:
+        return False
+    return bool(_MD_HEADING_RE.match(ln) or _KEYWORD_HEADING_RE.match(ln) or _NUMBERED_HEADING_RE.match(ln))
+
+def normalize_field_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", str(name).strip().lower()).strip("_")
+
+def split_deal_sections(pages_md):
+    """Split per-page OCR markdown into sections at headings, tracking page ranges."""
+    sections, cur = [], None
+    for pno, md in enumerate(pages_md, start=1):
+        for ln in str(md).splitlines():
+            if _is_section_heading(ln) or cur is None:
+                if cur and cur["text"].strip():
+                    sections.append(cur)
+                cur = {"title": ln.strip().lstrip("#").strip()[:120], "text": "", "page_start": pno, "page_end": pno}
+            cur["text"] += ln + "\n"
+            cur["page_end"] = pno
+    if cur and cur["text"].strip():
+        sections.append(cur)
+    return sections
+
+def _split_long_text(text: str, max_chars: int):
+    parts, buf = [], ""
+    for para in re.split(r"\n\s*\n", text):
+        while len(para) > max_chars:
+            parts.append(para[:max_chars])
+            para = para[max_chars:]
+        if buf and len(buf) + len(para) + 2 > max_chars:
+            parts.append(buf)
+            buf = ""
+        buf = f"{buf}\n\n{para}" if buf else para
+    if buf.strip():
+        parts.append(buf)
+    return parts
+
+def chunk_deal_sections(sections, max_chars: int = DEAL_CHUNK_CHARS):
+    """Pack whole sections into chunks of at most ~max_chars; oversized sections are split on paragraphs."""
+    chunks, cur = [], None
+
+    def flush():
+        nonlocal cur
+        if cur and cur["text"].strip():
+            cur["idx"] = len(chunks)
+            chunks.append(cur)
+        cur = None
+
+    for sec in sections:
+        pieces = _split_long_text(sec["text"], max_chars) if len(sec["text"]) > max_chars else [sec["text"]]
+        for piece in pieces:
+            if cur and len(cur["text"]) + len(piece) > max_chars:
+                flush()
+            if cur is None:
+                cur = {"text": "", "titles": [], "page_start": sec["page_start"], "page_end": sec["page_end"]}
+            cur["text"] += piece
+            cur["page_end"] = sec["page_end"]
+            if sec["title"] and sec["title"] not in cur["titles"]:
+                cur["titles"].append(sec["title"])
+    flush()
+    return chunks
+
+def extract_deal_fields_from_chunk(chunk: dict, fields, model_choice: str, openai_key: str):
+    """Return {field: [values…]} for one chunk; fields not found map to [].
+
+    Returns None when the LLM call itself failed, so the caller can leave the
+    chunk uncached instead of recording its fields as absent.
+    """
+    pages = f"{chunk['page_start']}-{chunk['page_end']}"
+    heading = "; ".join(chunk["titles"][:3])
+    text = f"[PAGES: {pages} | SECTION: {heading}]\n{chunk['text']}"
+    prompt = DEAL_PROMPT.format(fields=", ".join(fields))
+    payload = _langextract_payload(
+        text, model_choice, openai_key, prompt=prompt, examples=DEAL_EXAMPLES, max_output_tokens=1200,
+    )
+    if payload is None:
+        return None
+    found = {f: [] for f in fields}
+    for ext in payload.get("extractions", []):
+        cls = normalize_field_name(ext.get("extraction_class", ""))
+        if cls not in found:
+            continue
+        attrs = ext.get("attributes", {}) or {}
+        val = attrs.get("value") or ext.get("extraction_text")
+        if val and str(val).strip() and str(val).strip() not in found[cls]:
+            found[cls].append(str(val).strip())
+    return found
+
+def _deal_value_key(v: str) -> str:
+    x = " ".join(str(v).split()).strip(" .;:,").casefold()
+    n = _to_number(x) if re.fullmatch(r"[\d,.\s₹$()%-]+", x) else None
+    return f"#{n:g}" if n is not None else x
+
+def reduce_deal_fields(fields, chunk_results):
+    """Merge per-chunk candidates into one value per field.
+
+    ``chunk_results`` is a list of (chunk, {field: [values]}) in document order.
+    The value reported by the most chunks wins; ties go to the earliest chunk.
+    Losing candidates are kept as alternatives and the field is flagged as a conflict.
+    """
+    out = []
+    for field in fields:
+        votes = {}
+        for chunk, found in chunk_results:
+            for v in found.get(field, []):
+                key = _deal_value_key(v)
+                entry = votes.setdefault(key, {"value": v, "chunks": [], "pages": []})
+                if chunk["idx"] not in entry["chunks"]:
+                    entry["chunks"].append(chunk["idx"])
+                    pages = f"{chunk['page_start']}-{chunk['page_end']}"
+                    if pages not in entry["pages"]:
+                        entry["pages"].append(pages)
+        if not votes:
+            out.append({"field": field, "value": None, "pages": "", "support": 0, "conflict": False, "alternatives": ""})
+            continue
+        ranked = sorted(votes.values(), key=lambda e: (-len(e["chunks"]), min(e["chunks"])))
+        best = ranked[0]
+        out.append({
+            "field": field,
+            "value": best["value"],
+            "pages": ", ".join(best["pages"]),
+            "support": len(best["chunks"]),
+            "conflict": len(ranked) > 1,
+            "alternatives": "; ".join(e["value"] for e in ranked[1:]),
+        })
+    return out
 
 # PDF helpers (pure Python wheels: pypdf + pypdfium2)
 def decrypt_pdf_if_needed(pdf_bytes: bytes, pw: str | None):
@@ -701,11 +1354,528 @@ def render_pdf_to_images(pdf_bytes: bytes, scale: float = 2.0):
     pdf.close()
     return imgs
 
-# -----------------------------------------------------------
-# DATA RECONCILIATION PAGE
-# -----------------------------------------------------------
-if page == "datarecon":
-    st.markdown("""
+# Page pre-filter: predict, before full-resolution rendering and OCR, whether a
+# page can hold an ISIN holdings table. Text-layer pages are judged by whether any
+# ISIN appears; scanned pages are only skipped when a thumbnail is (nearly) blank.
+PREFILTER_MIN_TEXT_CHARS = 40   # fewer non-space chars means "no usable text layer"
+PREFILTER_THUMB_SCALE = 0.25
+PREFILTER_INK_LEVEL = 160       # grey level below which a thumbnail pixel counts as ink
+PREFILTER_BLANK_INK = 0.002     # ink fraction under which a page is treated as blank
+PREFILTER_MIN_WORD_RATIO = 0.5  # share of text in 3+ letter words for a layer to count as readable
+PREFILTER_REASONS = {"no_isin_text": "no ISIN in text layer", "blank": "blank page"}
+
+def looks_blank(img) -> bool:
+    gray = img.convert("L")
+    hist = gray.histogram()
+    return sum(hist[:PREFILTER_INK_LEVEL]) / max(1, gray.width * gray.height) < PREFILTER_BLANK_INK
+
+def text_layer_looks_real(text: str) -> bool:
+    """True for an extractable layer made of words, not mis-mapped glyphs or control junk."""
+    compact = re.sub(r"\s+", "", text)
+    if not compact or sum(ch == "\ufffd" or not ch.isprintable() for ch in compact) / len(compact) > 0.05:
+        return False
+    words = re.findall(r"[A-Za-z]{3,}", text)
+    return len(words) >= 5 and sum(map(len, words)) / len(compact) >= PREFILTER_MIN_WORD_RATIO
+
+def page_has_images(page) -> bool:
+    import pypdfium2.raw as pdfium_c
+    return next(page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE], max_depth=2), None) is not None
+
+def classify_pdf_page(page):
+    """Return None if the page should be processed, else a PREFILTER_REASONS key."""
+    try:
+        textpage = page.get_textpage()
+        text = textpage.get_text_range()
+        textpage.close()
+    except Exception:
+        text = ""
+    if len(re.sub(r"\s+", "", text)) >= PREFILTER_MIN_TEXT_CHARS:
+        if _find_all_isins_in_text(text):
+            return None
+        # Only trust "no ISIN" when the layer is readable text covering the page;
+        # a garbled layer or a scan under a digital header goes to the thumbnail check.
+        if text_layer_looks_real(text) and not page_has_images(page):
+            return "no_isin_text"
+    if looks_blank(page.render(scale=PREFILTER_THUMB_SCALE).to_pil()):
+        return "blank"
+    return None  # scanned page with content: can't tell cheaply, so process it
+
+def iter_pdf_images(pdf_bytes: bytes, scale: float = 2.0, prefilter: bool = False):
+    """Yield (page_count, PIL image, skip_reason) one page at a time so long documents are never all in memory.
+
+    With ``prefilter`` pages that classify_pdf_page rejects are not rendered;
+    they are yielded with ``None`` for the image and the reason key.
+    """
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        n = len(pdf)
+        for i in range(n):
+            page = pdf[i]
+            reason = classify_pdf_page(page) if prefilter else None
+            img = None if reason else page.render(scale=scale).to_pil()
+            page.close()
+            yield n, img, reason
+    finally:
+        pdf.close()
+
+def render_pdf_page_to_image(pdf_bytes: bytes, index: int, scale: float = 2.0):
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page = pdf[index]
+        img = page.render(scale=scale).to_pil()
+        page.close()
+        return img
+    finally:
+        pdf.close()
+
+# Statement pipeline: one uploaded file -> events, emitted as soon as each page finishes
+def process_statement_file(file_name: str, b: bytes, *, mistral_client, model: str, openai_key: str,
+                           pdf_password: str | None = None, add_assist: bool = False,
+                           mode: str = "llm_first", routing: str = "fixed", ledger=None,
+                           compact: str | None = "gray", prefilter: bool = True):
+    """Yield progress events for one statement file.
+
+    Events are dicts with a ``kind`` of "start" (``pages`` known), "page"
+    (``page``, ``pages``, ``rows`` for that page, ``upload`` OCR payload
+    stats, ``skipped`` pre-filter reason if the page was not OCR'd) or
+    "error"/"warning"/"info" (``msg``). Rows are canonicalized and tagged
+    with their source.
+    """
+    import hashlib
+
+    name = (file_name or "").lower()
+    file_sha256 = hashlib.sha256(b).hexdigest()  # statement identity for the history store
+    llm_kw = {"mode": mode, "routing": routing, "ledger": ledger, "source": file_name}
+    # OCR errors are collected and yielded as events: this generator may run on a
+    # worker thread, where Streamlit elements (popups) cannot be rendered.
+    ocr_errors = []
+
+    def ocr(data, mime):
+        return run_mistral_ocr_on_image_bytes(mistral_client, data, mime, on_error=ocr_errors.append)
+
+    def error_events():
+        while ocr_errors:
+            yield {"kind": "error", "file": file_name, "msg": f"{file_name}: {ocr_errors.pop(0)}"}
+
+    if name.endswith(".pdf"):
+        dec, stt = decrypt_pdf_if_needed(b, pdf_password)
+        if stt == "bad_password":
+            yield {"kind": "error", "file": file_name, "msg": f"Incorrect password for {file_name}."}
+            return
+        if stt == "protected":
+            yield {"kind": "warning", "file": file_name, "msg": f"{file_name} is password-protected; please provide the password."}
+            return
+        pdf_bytes = dec if dec is not None else b
+
+        last_sr_no = None
+        i = 0
+        # Render to images with pypdfium2 (no system deps), one page at a time
+        pages = iter_pdf_images(pdf_bytes, scale=2.0, prefilter=prefilter)
+        while True:
+            # Only rendering is fatal for the file; a page that fails later is reported and skipped.
+            try:
+                n, pg, skipped = next(pages)
+            except StopIteration:
+                break
+            except Exception as e:
+                yield {"kind": "error", "file": file_name, "msg": f"PDF render failed for {file_name} (page {i + 1}): {e}"}
+                break
+            i += 1
+            if i == 1:
+                yield {"kind": "start", "file": file_name, "pages": n}
+            if skipped:
+                yield {"kind": "page", "file": file_name, "page": i, "pages": n, "rows": [], "skipped": skipped}
+                continue
+            try:
+                data, mime, upload = prepare_image_for_ocr(pg, compact=compact)
+                md_text = ocr(data, mime)
+                chunks = segment_rows_by_isin(md_text)
+                span_prefix = f"[SOURCE_PDF: {file_name} | PAGE: {i}]"
+                page_rows = [
+                    extract_row_from_chunk(ch, f"{span_prefix} | {ch['row_text']}", model, openai_key, **llm_kw)
+                    for ch in chunks
+                ]
+            except Exception as e:
+                yield from error_events()
+                yield {"kind": "error", "file": file_name, "msg": f"{file_name}: page {i} failed: {e}"}
+                yield {"kind": "page", "file": file_name, "page": i, "pages": n, "rows": []}
+                continue
+            if add_assist:
+                def rescan(idx=i - 1):
+                    hi = render_pdf_page_to_image(pdf_bytes, idx, scale=ASSIST_RESCAN_SCALE)
+                    # No edge cap here: the extra resolution is the point of the rescan.
+                    hi_data, hi_mime, _ = prepare_image_for_ocr(hi, compact=compact, max_edge=None)
+                    return ocr(hi_data, hi_mime)
+                # The assist is optional: if it fails, the page keeps its first-pass rows.
+                try:
+                    page_rows += missed_row_assist(
+                        md_text, chunks, span_prefix=span_prefix, model=model, openai_key=openai_key,
+                        rescan=rescan, prev_sr_no=last_sr_no,
+                        rescan_prev=(lambda idx=i - 2: rescan(idx)) if i > 1 else None,
+                        prev_span_prefix=f"[SOURCE_PDF: {file_name} | PAGE: {i - 1}]",
+                        **llm_kw,
+                    )
+                except Exception as e:
+                    yield {"kind": "warning", "file": file_name, "msg": f"{file_name}: missed-row assist failed on page {i}: {e}"}
+            for pos, r in enumerate(page_rows):
+                r["source_pdf"] = file_name
+                r["source_sha256"] = file_sha256
+                r["page"] = i - 1 if r.get("assist") == "rescan_prev" else i
+                r["row_pos"] = pos
+            sr_nos = serial_sr_nos(chunks)
+            last_sr_no = max(sr_nos) if sr_nos else None
+            yield from error_events()
+            yield {"kind": "page", "file": file_name, "page": i, "pages": n, "rows": page_rows, "upload": upload}
+
+    elif name.endswith((".png", ".jpg", ".jpeg")):
+        yield {"kind": "start", "file": file_name, "pages": 1}
+        mime = "image/png" if name.endswith(".png") else "image/jpeg"
+        if prefilter:
+            try:
+                from PIL import Image
+                thumb = Image.open(BytesIO(b))
+                thumb.draft("L", (thumb.width // 4 or 1, thumb.height // 4 or 1))  # cheap JPEG downscale
+                if looks_blank(thumb):
+                    yield {"kind": "page", "file": file_name, "page": 1, "pages": 1, "rows": [], "skipped": "blank"}
+                    return
+            except Exception:
+                pass
+        try:
+            data, mime, upload = prepare_image_for_ocr(b, compact=compact, mime_hint=mime)
+        except Exception:
+            data, upload = b, {"bytes_before": len(b), "bytes_after": len(b), "format": mime.split("/")[-1].upper(), "size": None}
+        md_text = ocr(data, mime)
+        chunks = segment_rows_by_isin(md_text)
+        span_prefix = f"[SOURCE_IMAGE: {file_name}]"
+        img_rows = [
+            extract_row_from_chunk(ch, f"{span_prefix} | {ch['row_text']}", model, openai_key, **llm_kw)
+            for ch in chunks
+        ]
+        if add_assist:
+            # No higher-resolution source for uploaded images; line-range LLM pass only.
+            img_rows += missed_row_assist(
+                md_text, chunks, span_prefix=span_prefix, model=model, openai_key=openai_key, **llm_kw,
+            )
+        for pos, r in enumerate(img_rows):
+            r["source_image"] = file_name
+            r["source_sha256"] = file_sha256
+            r["page"] = 1
+            r["row_pos"] = pos
+        yield from error_events()
+        yield {"kind": "page", "file": file_name, "page": 1, "pages": 1, "rows": img_rows, "upload": upload}
+    else:
+        yield {"kind": "info", "file": file_name, "msg": f"Skipping {file_name} (unsupported)."}
+
+# Bulk ingestion: uploads and ZIP members become lazily-read sources that feed a
+# bounded pool of per-file workers.
+STATEMENT_EXTS = (".pdf", ".png", ".jpg", ".jpeg")
+FILE_WORKERS = 4
+
+def load_password_map(b: bytes) -> dict:
+    """Parse a "filename,password" CSV (header optional) into {lowercased name: password}."""
+    import csv
+
+    out = {}
+    for row in csv.reader(b.decode("utf-8-sig", errors="replace").splitlines()):
+        if len(row) < 2 or not row[0].strip():
+            continue
+        fname, pw = row[0].strip(), row[1]
+        if fname.lower() in ("filename", "file", "file_name") and pw.strip().lower() == "password":
+            continue
+        out[fname.lower()] = pw
+    return out
+
+def lookup_password(name: str, password_map: dict, default: str | None = None):
+    """Match a source by full "archive.zip/member" path, then member path, then bare file name."""
+    key = name.lower()
+    for k in (key, key.split("/", 1)[-1], key.rsplit("/", 1)[-1]):
+        if k in password_map:
+            return password_map[k]
+    return default
+
+def iter_statement_sources(uploads):
+    """Yield (display_name, read) for each statement; ZIP archives are expanded member by member.
+
+    ``read`` returns the bytes on demand, so archive members are only
+    decompressed when a worker picks them up.
+    """
+    import zipfile
+
+    for f in uploads:
+        if not (f.name or "").lower().endswith(".zip"):
+            yield f.name, f.getvalue
+            continue
+        try:
+            zf = zipfile.ZipFile(f)
+        except zipfile.BadZipFile:
+            yield f.name, f.getvalue  # surfaces as "unsupported" downstream
+            continue
+        for info in zf.infolist():
+            member = info.filename
+            base = member.rsplit("/", 1)[-1]
+            if info.is_dir() or member.startswith("__MACOSX/") or base.startswith("."):
+                continue
+            if base.lower().endswith(STATEMENT_EXTS):
+                yield f"{f.name}/{member}", (lambda zf=zf, info=info: zf.read(info))
+
+def run_statement_worker(q, name: str, read, kw: dict):
+    """Worker body: push a file's events onto ``q`` and always finish with a "done" event."""
+    try:
+        for ev in process_statement_file(name, read(), **kw):
+            q.put(ev)
+    except Exception as e:
+        q.put({"kind": "error", "file": name, "msg": f"Processing failed for {name}: {e}"})
+    finally:
+        q.put({"kind": "done", "file": name})
+
+# On-demand profiling: a wall-clock stack sampler (folded stacks, flame-graph
+# compatible) plus tracemalloc allocation stats. Nothing runs unless enabled.
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds
+PROFILE_TOP_ALLOCS = 30
+
+@contextmanager
+def profiled_run(enabled: bool, interval: float = PROFILE_SAMPLE_INTERVAL):
+    """Profile the enclosed block when ``enabled``; the yielded dict is filled on exit.
+
+    Report keys: ``folded`` (one "frame;frame;… count" line per stack, for
+    flamegraph.pl / speedscope), ``alloc`` (top allocation sites as text),
+    ``samples``, ``wall_s`` and ``peak_mb``.
+    """
+    report = {}
+    if not enabled:
+        yield report
+        return
+
+    import tracemalloc
+    from collections import Counter
+
+    stacks = Counter()
+    stop = threading.Event()
+    run_ident = threading.get_ident()
+    # Only sample this script thread and threads it starts, not Streamlit's server threads.
+    ignore = {t.ident for t in threading.enumerate()} - {run_ident}
+
+    def sample():
+        me = threading.get_ident()
+        while not stop.wait(interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me or tid in ignore:
+                    continue
+                parts = []
+                while frame is not None:
+                    co = frame.f_code
+                    parts.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                    frame = frame.f_back
+                parts.append(names.get(tid, str(tid)))
+                stacks[";".join(reversed(parts))] += 1
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(10)
+    sampler = threading.Thread(target=sample, name="stack-sampler", daemon=True)
+    t0 = time.perf_counter()
+    sampler.start()
+    try:
+        yield report
+    finally:
+        stop.set()
+        sampler.join()
+        snap = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        top = snap.statistics("lineno")[:PROFILE_TOP_ALLOCS]
+        report.update(
+            folded="\n".join(f"{stack} {n}" for stack, n in stacks.most_common()),
+            alloc="\n".join(str(stat) for stat in top),
+            samples=sum(stacks.values()),
+            wall_s=time.perf_counter() - t0,
+            peak_mb=peak / 1e6,
+        )
+
+LIVE_COLS = ["source", "page", "sr_no", "isin", "security_name", "value"]
+LIVE_REFRESH_S = 1.0          # min seconds between live table refreshes
+LIVE_EXPORT_REFRESH_S = 15.0  # min seconds between partial export refreshes (the CSV is resent whole)
+
+def live_view_row(r: dict) -> dict:
+    return {
+        "source": r.get("source_pdf") or r.get("source_image"),
+        "page": r.get("page"),
+        "sr_no": r.get("sr_no"),
+        "isin": r.get("isin"),
+        "security_name": r.get("security_name"),
+        "value": r.get("value"),
+    }
+
+def download_link_html(data: bytes, file_name: str, mime: str, label: str) -> str:
+    """Inline data-URL download link; unlike st.download_button it does not trigger a rerun mid-run."""
+    b64 = base64.b64encode(data).decode("utf-8")
+    return (
+        f'<a class="sxDownload" download="{escape(file_name)}" href="data:{mime};base64,{b64}" '
+        'style="display:inline-block; padding:6px 14px; border-radius:10px; background:var(--btn-bg); '
+        f'color:var(--btn-text); text-decoration:none;">{escape(label)}</a>'
+    )
+
+# Historical holdings store: canonicalized rows from every run, appended to a local
+# SQLite file and indexed by ISIN, statement date and source file.
+HISTORY_DB_PATH = os.environ.get(
+    "STACK_HISTORY_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "holdings_history.sqlite3"),
+)
+HISTORY_COLS = [
+    "run_tag", "ingested_at", "source_file", "source_sha256", "page", "row_pos", "sr_no", "isin",
+    "security_name", "statement_date", "balance", "market_rate", "market_value", "value", "status",
+    "extraction_path", "extra",
+]
+# Row keys that only identify a row for the store; kept out of the Excel export.
+HISTORY_ONLY_KEYS = ["source_sha256", "row_pos"]
+_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS holdings (
+    id INTEGER PRIMARY KEY,
+    run_tag TEXT NOT NULL,
+    ingested_at TEXT NOT NULL,
+    source_file TEXT,
+    source_sha256 TEXT,
+    page INTEGER,
+    row_pos INTEGER,
+    sr_no INTEGER,
+    isin TEXT,
+    security_name TEXT,
+    statement_date TEXT,
+    balance REAL,
+    market_rate REAL,
+    market_value REAL,
+    value REAL,
+    status TEXT,
+    extraction_path TEXT,
+    extra TEXT
+);
+"""
+_HISTORY_INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_holdings_isin_date ON holdings(isin, statement_date);
+CREATE INDEX IF NOT EXISTS ix_holdings_date ON holdings(statement_date);
+CREATE INDEX IF NOT EXISTS ix_holdings_source_date ON holdings(source_file, statement_date);
+-- A statement is identified by the SHA-256 of its bytes, never by its file name
+-- or date; re-ingesting the same bytes is a no-op (INSERT OR IGNORE).
+CREATE UNIQUE INDEX IF NOT EXISTS ux_holdings_stmt_row ON holdings(
+    source_sha256, page, row_pos, COALESCE(sr_no, -1), COALESCE(isin, '')
+);
+"""
+
+def history_connect(path: str = HISTORY_DB_PATH):
+    import sqlite3
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(_HISTORY_TABLE)
+    con.executescript(_HISTORY_INDEXES)
+    return con
+
+def to_iso_date(x):
+    if x in (None, ""):
+        return None
+    try:
+        from dateutil import parser as dateparser
+        return dateparser.parse(str(x), dayfirst=True, fuzzy=True).date().isoformat()
+    except Exception:
+        return None
+
+def _history_record(r: dict, run_tag: str, ingested_at: str, statement_date):
+    core = {
+        "run_tag": run_tag,
+        "ingested_at": ingested_at,
+        "source_file": r.get("source_pdf") or r.get("source_image"),
+        "source_sha256": r.get("source_sha256"),
+        "page": r.get("page"),
+        "row_pos": r.get("row_pos"),
+        "sr_no": r.get("sr_no"),
+        "isin": r.get("isin"),
+        "security_name": r.get("security_name"),
+        "statement_date": statement_date,
+        "balance": _to_number(r.get("balance")),
+        "market_rate": _to_number(r.get("market_rate")),
+        "market_value": _to_number(r.get("market_value")),
+        "value": _to_number(r.get("value")),
+        "status": r.get("status"),
+        "extraction_path": r.get("extraction_path"),
+    }
+    skip = set(core) | {"date", "source_pdf", "source_image"}
+    core["extra"] = json.dumps({k: v for k, v in r.items() if k not in skip}, default=str)
+    return tuple(core[c] for c in HISTORY_COLS)
+
+def append_rows_to_history(rows, run_tag: str, path: str = HISTORY_DB_PATH) -> int:
+    """Append canonicalized rows in one transaction; returns the number of new rows written.
+
+    Rows are keyed by their statement's ``source_sha256`` plus page, row
+    position, sr_no and ISIN, so only a re-run of the identical file is
+    skipped. Rows without a parseable date inherit the most common date of
+    their statement (same hash), since statements usually print the as-of
+    date once per page; the date is never part of the key.
+    """
+    from collections import Counter
+
+    def stmt_key(r):
+        return r.get("source_sha256") or (r.get("source_pdf") or r.get("source_image"))
+
+    file_dates = {}
+    for r in rows:
+        d = to_iso_date(r.get("date"))
+        if d:
+            file_dates.setdefault(stmt_key(r), Counter())[d] += 1
+    ingested_at = datetime.now().isoformat(timespec="seconds")
+    records = []
+    for r in rows:
+        src = stmt_key(r)
+        d = to_iso_date(r.get("date"))
+        if not d and file_dates.get(src):
+            d = file_dates[src].most_common(1)[0][0]
+        records.append(_history_record(r, run_tag, ingested_at, d))
+    con = history_connect(path)
+    try:
+        with con:
+            before = con.total_changes
+            con.executemany(
+                f"INSERT OR IGNORE INTO holdings ({', '.join(HISTORY_COLS)}) "
+                f"VALUES ({', '.join('?' for _ in HISTORY_COLS)})",
+                records,
+            )
+            written = con.total_changes - before
+    finally:
+        con.close()
+    return written
+
+def query_history(*, isin=None, date_from=None, date_to=None, source_like=None, limit: int = 5000,
+                  path: str = HISTORY_DB_PATH):
+    """Return (columns, rows) for an ISIN / date-range / source lookup, newest first."""
+    where, params = [], []
+    if isin:
+        where.append("isin = ?")
+        params.append(str(isin).replace(" ", "").upper())
+    if date_from:
+        where.append("statement_date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        where.append("statement_date <= ?")
+        params.append(str(date_to))
+    if source_like:
+        where.append("source_file LIKE ?")
+        params.append(f"%{source_like}%")
+    cols = [c for c in HISTORY_COLS if c != "extra"]
+    sql = f"SELECT {', '.join(cols)} FROM holdings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY statement_date DESC, source_file, sr_no LIMIT ?"
+    params.append(int(limit))
+    con = history_connect(path)
+    try:
+        return cols, con.execute(sql, params).fetchall()
+    finally:
+        con.close()
+
+FORM_PAGE_CSS = """
     <style>
       .rail{ margin-bottom: 2px !important; }
       .formWrap{ width:min(70vw,980px); margin: 0 auto 72px auto !important; }
@@ -714,25 +1884,52 @@ if page == "datarecon":
       [data-testid="stTextInput"] button[aria-label="Show password"], [data-testid="stTextInput"] button[aria-label="Hide password"]{ margin-right: 0 !important; }
       [data-baseweb="input"]{ padding-right: 6px !important; }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# -----------------------------------------------------------
+# DATA RECONCILIATION PAGE
+# -----------------------------------------------------------
+if page == "datarecon":
+    st.markdown(FORM_PAGE_CSS, unsafe_allow_html=True)
 
     with st.form("recon_form", border=False):
         st.markdown('<div class="formHead">Data Reconciliation</div>', unsafe_allow_html=True)
 
         files = st.file_uploader(
-            "Upload Statements (Accepted formats: PDF/PNG/JPG/JPEG)",
-            type=["pdf", "png", "jpg", "jpeg"],
+            "Upload Statements (Accepted formats: PDF/PNG/JPG/JPEG, or ZIP archives of them)",
+            type=["pdf", "png", "jpg", "jpeg", "zip"],
             accept_multiple_files=True,
         )
 
         colA, colB = st.columns([1, 1])
         with colA:
             pdf_password = st.text_input(
-                "PDF password (optional) (If file is password protected, upload single file at a time)",
+                "PDF password (optional) (used for any file not in the password map)",
                 type="password",
             )
+            password_csv = st.file_uploader(
+                "Password map (optional CSV: filename,password)",
+                type=["csv"],
+                accept_multiple_files=False,
+            )
+            workers = st.slider("Files processed in parallel", 1, 8, FILE_WORKERS)
         with colB:
             add_assist = st.checkbox("Conservative ‘missed row’ assist", value=False)
+            process_all_pages = st.checkbox(
+                "Process every page (no pre-filter)",
+                value=False,
+                help="By default, pages whose text layer has no ISIN, and blank scanned pages, skip rendering and OCR.",
+            )
+            save_history = st.checkbox(
+                "Save rows to holdings history",
+                value=True,
+                help="Appends this run's rows to the local history store (see Holdings History).",
+            )
+            profile_run = st.checkbox(
+                "Profile this run",
+                value=False,
+                help="Samples call stacks and allocations; offers a flame-graph profile for download. Adds overhead.",
+            )
 
         with st.expander("API keys (required – not stored on disk)", expanded=True):
             c1, c2 = st.columns(2)
@@ -758,6 +1955,30 @@ if page == "datarecon":
             index=0,
         )
 
+        compact_label = st.selectbox(
+            "OCR image compaction",
+            list(OCR_COMPACT_MODES),
+            index=0,
+            help="Trims margins, drops colour and caps resolution before upload to cut OCR payload size.",
+        )
+
+        extraction_label = st.selectbox(
+            "Extraction mode",
+            list(EXTRACTION_MODES),
+            index=0,
+            help="Deterministic first: rows that pass ISIN check-digit and balance × rate ≈ value checks skip the LLM.",
+        )
+
+        colR, colC = st.columns([1, 1])
+        with colR:
+            routing_label = st.selectbox("Model routing", list(ROUTING_MODES), index=0)
+        with colC:
+            budget_usd = st.number_input(
+                "LLM budget cap per run (USD, 0 = no cap)",
+                min_value=0.0, value=0.0, step=0.5, format="%.2f",
+                help="Once reached, remaining rows are parsed deterministically without LLM calls.",
+            )
+
         run = st.form_submit_button("Run Reconciliation")
 
     if run:
@@ -792,96 +2013,469 @@ if page == "datarecon":
             show_popup_warning("Please enter MISTRAL_API_KEY and OPENAI_API_KEY in the form above.")
             st.stop()
 
+        import queue
         import pandas as pd
+        from concurrent.futures import ThreadPoolExecutor
         from mistralai import Mistral
 
         mistral_client = Mistral(api_key=mistral_key)
 
         RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M%S")
         all_rows = []
+        ledger = UsageLedger(budget_usd=budget_usd)
+        uploads = []  # OCR payload stats per page
+
+        with profiled_run(profile_run) as prof_report:
+            # Live view: placeholders are updated in place as each page finishes.
+            status = st.status("Processing…", expanded=False)
+            counters_ph = st.empty()
+            table_ph = st.empty()
+            export_ph = st.empty()
+
+            password_map = load_password_map(password_csv.getvalue()) if password_csv else {}
+            sources = []
+            seen_names = set()
+            for orig_name, read in iter_statement_sources(files):
+                sname, n_dup = orig_name, 1
+                while sname in seen_names:
+                    n_dup += 1
+                    sname = f"{orig_name} ({n_dup})"
+                seen_names.add(sname)
+                # The de-duplicated name is for display; passwords are keyed by the original name.
+                sources.append((sname, orig_name, read))
+            if not sources:
+                status.update(label="Nothing to process", state="error")
+                show_popup_warning("No PDF/PNG/JPG statements found in the upload.")
+                st.stop()
+            source_order = {sname: idx for idx, (sname, _, _) in enumerate(sources)}
+
+            # file -> {"pages": total or None, "done": pages finished, "rows": rows so far}
+            file_progress = {sname: {"pages": None, "done": 0, "rows": 0, "skipped": 0} for sname, _, _ in sources}
+            skipped_pages = {}  # pre-filter reason -> count
+            popups = {"error": show_popup_error, "warning": show_popup_warning, "info": show_popup_info}
+
+            def render_counters():
+                finished = sum(1 for p in file_progress.values() if p.get("finished"))
+                lines = [f"**Files:** {finished}/{len(file_progress)} done", "", "| File | Pages | Skipped | Rows |", "|---|---|---|---|"]
+                for fname, p in file_progress.items():
+                    total = p["pages"] if p["pages"] is not None else "…"
+                    lines.append(f"| {escape(fname).replace('|', '&#124;')} | {p['done']}/{total} | {p['skipped']} | {p['rows']} |")
+                counters_ph.markdown("\n".join(lines))
+
+            render_counters()
+            worker_kw = dict(
+                mistral_client=mistral_client, model=model, openai_key=openai_key, add_assist=add_assist,
+                mode=EXTRACTION_MODES[extraction_label], routing=ROUTING_MODES[routing_label], ledger=ledger,
+                compact=OCR_COMPACT_MODES[compact_label], prefilter=not process_all_pages,
+            )
+            events = queue.Queue()
+            pool = ThreadPoolExecutor(max_workers=min(workers, len(sources)))
+            try:
+                for sname, orig_name, read in sources:
+                    pool.submit(
+                        run_statement_worker, events, sname, read,
+                        {**worker_kw, "pdf_password": lookup_password(orig_name, password_map, pdf_password)},
+                    )
+                pending = len(sources)
+                last_live = last_export = 0.0
+                while pending:
+                    ev = events.get()
+                    prog = file_progress[ev["file"]]
+                    if ev["kind"] in popups:
+                        popups[ev["kind"]](ev["msg"])
+                        continue
+                    if ev["kind"] == "done":
+                        pending -= 1
+                        prog["finished"] = True
+                    elif ev["kind"] == "start":
+                        prog["pages"] = ev["pages"]
+                    elif ev["kind"] == "page":
+                        prog["done"] += 1
+                        prog["rows"] += len(ev["rows"])
+                        if ev.get("skipped"):
+                            prog["skipped"] += 1
+                            skipped_pages[ev["skipped"]] = skipped_pages.get(ev["skipped"], 0) + 1
+                        if ev.get("upload"):
+                            uploads.append({"file": ev["file"], "page": ev["page"], **ev["upload"]})
+                        all_rows.extend(ev["rows"])
+                        status.update(label=f"Processing {ev['file']} – page {ev['page']}/{ev['pages']}…")
+                        if ev["rows"] and time.monotonic() - last_live >= LIVE_REFRESH_S:
+                            last_live = time.monotonic()
+                            live = pd.DataFrame([live_view_row(r) for r in all_rows], columns=LIVE_COLS)
+                            table_ph.dataframe(live, use_container_width=True)
+                        if ev["rows"] and time.monotonic() - last_export >= LIVE_EXPORT_REFRESH_S:
+                            last_export = time.monotonic()
+                            live = pd.DataFrame([live_view_row(r) for r in all_rows], columns=LIVE_COLS)
+                            export_ph.markdown(
+                                download_link_html(
+                                    live.to_csv(index=False).encode("utf-8"),
+                                    f"partial_extract_{RUN_TAG}.csv", "text/csv",
+                                    f"Download partial export ({len(live)} rows)",
+                                ),
+                                unsafe_allow_html=True,
+                            )
+                    render_counters()
+            finally:
+                # Don't block a rerun/stop on queued files; in-flight ones finish in the background.
+                pool.shutdown(wait=False, cancel_futures=True)
+
+            # Workers finish in any order; restore upload order before de-dup.
+            all_rows.sort(key=lambda r: (
+                source_order.get(r.get("source_pdf") or r.get("source_image"), 0),
+                r.get("page") or 0,
+            ))
+
+            status.update(label="Building Excel…", state="running")
+            export_ph.empty()
+
+            if not all_rows:
+                status.update(label="No rows extracted", state="error")
+                hint = " or tick 'Process every page'" if skipped_pages else ""
+                show_popup_warning(f"No rows extracted. Try a different page or a crisper scan{hint}.")
+                st.stop()
+
+            # The history store keeps every statement's rows (it has its own key);
+            # the de-dup below is for the Excel view only.
+            history_rows = list(all_rows)
+
+            # De-dup & DataFrame
+            def tidy_name(x): return tidy_security_name(x or "")
+            seen = set()
+            dedup = []
+            for r in all_rows:
+                key = (
+                    (r.get("isin") or "").strip().upper(),
+                    tidy_name(r.get("security_name")),
+                    str(r.get("value") or r.get("market_value") or "").strip(),
+                )
+                if key in seen:
+                    continue
+                seen.add(key)
+                dedup.append(r)
+            all_rows = dedup
+
+            base_cols = ["date", "isin", "security_name", "value"]
+            all_keys = set().union(*[r.keys() for r in all_rows])
+            extra_cols = [c for c in sorted(all_keys) if c not in base_cols + ["_span"] + HISTORY_ONLY_KEYS]
+            ordered_cols = base_cols + ["_span"] + extra_cols + ["sr_no"]
+            df = pd.DataFrame(all_rows).reindex(columns=ordered_cols)
+
+            # Excel to bytes
+            out_name = f"extracted_transactions_{RUN_TAG}.xlsx"
+            try:
+                import xlsxwriter  # noqa
+                engine = "xlsxwriter"
+            except Exception:
+                engine = None  # Pandas will try openpyxl if present
+
+            usage_df = pd.DataFrame(
+                ledger.summary(),
+                columns=["source", "model", "calls", "failed", "tokens_in", "tokens_out", "latency_s", "avg_latency_s", "cost_usd"],
+            )
+
+            out_buf = BytesIO()
+            with pd.ExcelWriter(out_buf, engine=engine) as writer:
+                df.to_excel(writer, index=False, sheet_name="Extract")
+                usage_df.to_excel(writer, index=False, sheet_name="LLM usage")
+                if engine == "xlsxwriter":
+                    wb = writer.book
+                    ws = writer.sheets["Extract"]
+                    ws.freeze_panes(1, 0)
+                    width_map = {"date": 12, "isin": 20, "security_name": 40, "value": 18, "_span": 60, "sr_no": 8}
+                    for i, col in enumerate(df.columns):
+                        ws.set_column(i, i, width_map.get(col, 18))
+                    num_fmt = wb.add_format({"num_format": "#,##0"})
+                    if "value" in df.columns:
+                        ci = df.columns.get_loc("value")
+                        ws.set_column(ci, ci, 18, num_fmt)
+
+        status.update(label=f"Done – {len(df)} rows", state="complete")
+        st.success(f"Done. {len(df)} rows.")
+        if skipped_pages:
+            st.caption(
+                f"Pre-filter skipped {sum(skipped_pages.values())} page(s) before OCR: "
+                + ", ".join(f"{PREFILTER_REASONS.get(k, k)} {v}" for k, v in skipped_pages.items())
+            )
+        if "extraction_path" in df.columns:
+            path_counts = df["extraction_path"].value_counts()
+            st.caption(
+                "Rows by extraction path: "
+                + ", ".join(f"{k} {v}" for k, v in path_counts.items())
+                + f" · LLM attempts (incl. failed): {len(ledger.calls)}"
+            )
+        table_ph.dataframe(df, use_container_width=True)
+        st.download_button(
+            "Download Excel",
+            data=out_buf.getvalue(),
+            file_name=out_name,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+        if uploads:
+            up_df = pd.DataFrame(uploads)
+            before, after = int(up_df["bytes_before"].sum()), int(up_df["bytes_after"].sum())
+            saved = (1 - after / before) * 100 if before else 0.0
+            with st.expander(
+                f"OCR upload: {before / 1e6:.2f} MB → {after / 1e6:.2f} MB ({saved:.0f}% smaller) over {len(up_df)} pages",
+                expanded=False,
+            ):
+                st.dataframe(up_df, use_container_width=True)
+                st.caption("For compacted PDF pages, bytes_before is estimated from sampled strips of the rendered page.")
+
+        budget_note = f" of ${ledger.budget_usd:.2f} budget" if ledger.budget_usd else ""
+        with st.expander(
+            f"LLM usage: {int(usage_df['calls'].sum())} calls, ~{int(usage_df['tokens_in'].sum() + usage_df['tokens_out'].sum()):,} tokens, "
+            f"est. ${ledger.spent_usd:.4f}{budget_note}",
+            expanded=False,
+        ):
+            st.dataframe(usage_df, use_container_width=True)
+            st.caption(
+                "Every attempt is counted, including failed ones. Where the API reports no usage, input tokens are "
+                "estimated from text length (~4 characters per token) and output is charged at the max output "
+                "tokens; costs use list prices."
+            )
+        if ledger.exhausted():
+            show_popup_warning("LLM budget cap reached; remaining rows were parsed deterministically.")
+
+        if save_history:
+            try:
+                n_saved = append_rows_to_history(history_rows, RUN_TAG)
+                st.caption(f"Saved {n_saved} new rows to holdings history.")
+            except Exception as e:
+                show_popup_error(f"Could not save rows to holdings history: {e}")
+
+        if prof_report:
+            st.caption(
+                f"Profile: {prof_report['samples']} stack samples over {prof_report['wall_s']:.1f}s, "
+                f"peak traced memory {prof_report['peak_mb']:.1f} MB."
+            )
+            st.markdown(
+                download_link_html(
+                    prof_report["folded"].encode("utf-8"), f"profile_{RUN_TAG}.folded", "text/plain",
+                    "Download flame-graph profile (folded stacks)",
+                ) + " " + download_link_html(
+                    prof_report["alloc"].encode("utf-8"), f"allocations_{RUN_TAG}.txt", "text/plain",
+                    "Download allocation stats",
+                ),
+                unsafe_allow_html=True,
+            )
+
+# -----------------------------------------------------------
+# DEAL DOCUMENT PARSING PAGE
+# -----------------------------------------------------------
+if page == "dealparse":
+    st.markdown(FORM_PAGE_CSS, unsafe_allow_html=True)
+
+    # OCR'd pages, chunks and per-chunk field results, keyed by document hash, so
+    # the same document can be re-queried for new fields without re-OCR.
+    deal_cache = st.session_state.setdefault("dealparse_cache", {})
+
+    with st.form("deal_form", border=False):
+        st.markdown('<div class="formHead">Deal Document Parsing</div>', unsafe_allow_html=True)
+
+        deal_file = st.file_uploader(
+            "Upload Deal Document (Accepted formats: PDF/PNG/JPG/JPEG)",
+            type=["pdf", "png", "jpg", "jpeg"],
+            accept_multiple_files=False,
+        )
+
+        colA, colB = st.columns([1, 1])
+        with colA:
+            deal_password = st.text_input("PDF password (optional)", type="password")
+        with colB:
+            workers = st.slider("Parallel extraction calls", 1, 8, DEAL_MAX_WORKERS)
+
+        fields_text = st.text_area(
+            "Fields to extract (one per line)",
+            value="\n".join(DEAL_DEFAULT_FIELDS),
+            height=180,
+        )
+
+        with st.expander("API keys (required – not stored on disk)", expanded=True):
+            c1, c2 = st.columns(2)
+            with c1:
+                mistral_key = st.text_input(
+                    "MISTRAL_API_KEY",
+                    value=st.session_state.get("MISTRAL_API_KEY", ""),
+                    type="password",
+                    help="Used for OCR (mistral-ocr-latest)."
+                )
+            with c2:
+                openai_key = st.text_input(
+                    "OPENAI_API_KEY",
+                    value=st.session_state.get("OPENAI_API_KEY", ""),
+                    type="password",
+                    help="Used by LangExtract for field extraction."
+                )
+            remember = st.checkbox("Remember in this browser session", value=True)
+
+        model = st.selectbox(
+            "Extraction model (LangExtract)",
+            ["gpt-5-nano-2025-08-07", "openai:gpt-5-nano", "openai:gpt-5-mini", "openai:gpt-4.1-mini"],
+            index=0,
+        )
+
+        run = st.form_submit_button("Parse Document")
+
+    if deal_cache and st.button("Clear cached documents"):
+        deal_cache.clear()
 
-        with st.status("Processing…", expanded=False) as status:
-            for f in files:
-                name = (f.name or "").lower()
-                b = f.read()
+    if run:
+        if remember:
+            st.session_state["MISTRAL_API_KEY"] = mistral_key
+            st.session_state["OPENAI_API_KEY"] = openai_key
 
+        missing = ensure_runtime_dependencies(
+            (
+                ("pandas", "pandas"),
+                ("mistralai", "mistralai"),
+                ("langextract[openai]", "langextract"),
+                ("pypdfium2", "pypdfium2"),
+                ("pypdf", "pypdf"),
+                ("pillow", "PIL"),
+            )
+        )
+        if missing:
+            show_popup_error(
+                "Unable to install required packages automatically. "
+                "Please install before running: " + ", ".join(sorted(missing))
+            )
+            st.stop()
+
+        if not deal_file:
+            show_popup_warning("Please upload a deal document.")
+            st.stop()
+
+        fields = []
+        for ln in fields_text.splitlines():
+            fn = normalize_field_name(ln)
+            if fn and fn not in fields:
+                fields.append(fn)
+        if not fields:
+            show_popup_warning("Please list at least one field to extract.")
+            st.stop()
+
+        import hashlib
+        import pandas as pd
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        b = deal_file.getvalue()
+        doc_key = hashlib.sha256(b).hexdigest()
+        doc = deal_cache.get(doc_key)
+
+        if doc is None:
+            if not mistral_key:
+                show_popup_warning("Please enter MISTRAL_API_KEY in the form above.")
+                st.stop()
+            from mistralai import Mistral
+            mistral_client = Mistral(api_key=mistral_key)
+
+            name = (deal_file.name or "").lower()
+            pages_md = []
+            ocr_errors = []
+
+            def ocr(data, mime):
+                def on_error(msg):
+                    ocr_errors.append(msg)
+                    show_popup_error(msg)
+                return run_mistral_ocr_on_image_bytes(mistral_client, data, mime, on_error=on_error)
+
+            with st.status("Running OCR…", expanded=False) as status:
                 if name.endswith(".pdf"):
-                    dec, stt = decrypt_pdf_if_needed(b, pdf_password)
+                    dec, stt = decrypt_pdf_if_needed(b, deal_password)
                     if stt == "bad_password":
-                        show_popup_error(f"Incorrect password for {f.name}.")
-                        continue
+                        show_popup_error(f"Incorrect password for {deal_file.name}.")
+                        st.stop()
                     if stt == "protected":
-                        show_popup_warning(f"{f.name} is password-protected; please provide the password.")
-                        continue
-                    pdf_bytes = dec if dec is not None else b
-
-                    # Render to images with pypdfium2 (no system deps)
+                        show_popup_warning(f"{deal_file.name} is password-protected; please provide the password.")
+                        st.stop()
                     try:
-                        pages = render_pdf_to_images(pdf_bytes, scale=2.0)
+                        for n, img, _ in iter_pdf_images(dec if dec is not None else b, scale=2.0):
+                            status.update(label=f"Running OCR… page {len(pages_md) + 1}/{n}")
+                            data, mime, _ = prepare_image_for_ocr(img)
+                            pages_md.append(ocr(data, mime))
                     except Exception as e:
-                        show_popup_error(f"PDF render failed for {f.name}: {e}")
-                        continue
-
-                    for i, pg in enumerate(pages, start=1):
-                        buf = BytesIO()
-                        pg.save(buf, format="PNG")
-                        md_text = run_mistral_ocr_on_image_bytes(mistral_client, buf.getvalue(), "image/png")
-                        chunks = segment_rows_by_isin(md_text)
-                        for ch in chunks:
-                            span_tag = f"[SOURCE_PDF: {f.name} | PAGE: {i}] | {ch['row_text']}"
-                            recs = extract_records_with_langextract(span_tag, model, openai_key=openai_key)
-                            r = recs[0] if len(recs) == 1 else parse_single_row_fallback(ch["row_text"])
-                            r = canonicalize_row(r)
-                            r["source_pdf"] = f.name
-                            r["page"] = i
-                            r["sr_no"] = ch.get("sr_no")
-                            all_rows.append(r)
-
-                elif name.endswith((".png", ".jpg", ".jpeg")):
-                    mime = "image/png" if name.endswith(".png") else "image/jpeg"
-                    md_text = run_mistral_ocr_on_image_bytes(mistral_client, b, mime)
-                    chunks = segment_rows_by_isin(md_text)
-                    for ch in chunks:
-                        span_tag = f"[SOURCE_IMAGE: {f.name}] | {ch['row_text']}"
-                        recs = extract_records_with_langextract(span_tag, model, openai_key=openai_key)
-                        r = recs[0] if len(recs) == 1 else parse_single_row_fallback(ch["row_text"])
-                        r = canonicalize_row(r)
-                        r["source_image"] = f.name
-                        r["sr_no"] = ch.get("sr_no")
-                        all_rows.append(r)
+                        show_popup_error(f"PDF render failed for {deal_file.name}: {e}")
+                        st.stop()
                 else:
-                    show_popup_info(f"Skipping {f.name} (unsupported).")
-
-            status.update(label="Building Excel…", state="running")
-
-        if not all_rows:
-            show_popup_warning("No rows extracted. Try a different page or a crisper scan.")
+                    mime = "image/png" if name.endswith(".png") else "image/jpeg"
+                    pages_md.append(ocr(b, mime))
+                status.update(label="OCR complete", state="complete")
+
+            if not any(md.strip() for md in pages_md):
+                show_popup_warning("OCR returned no text. Try a crisper scan.")
+                st.stop()
+
+            doc = {
+                "name": deal_file.name,
+                "pages": len(pages_md),
+                "chunks": chunk_deal_sections(split_deal_sections(pages_md)),
+                "results": {},  # (chunk_idx, model, field) -> [values]
+            }
+            if ocr_errors:
+                # A failed page reads as empty text; don't let that stick for the session.
+                show_popup_info(f"OCR failed on {len(ocr_errors)} page(s); this document is not cached, re-run to retry.")
+            else:
+                deal_cache[doc_key] = doc
+
+        if not openai_key:
+            show_popup_warning("Please enter OPENAI_API_KEY in the form above.")
             st.stop()
 
-        # De-dup & DataFrame
-        def tidy_name(x): return tidy_security_name(x or "")
-        seen = set()
-        dedup = []
-        for r in all_rows:
-            key = (
-                (r.get("isin") or "").strip().upper(),
-                tidy_name(r.get("security_name")),
-                str(r.get("value") or r.get("market_value") or "").strip(),
-            )
-            if key in seen:
-                continue
-            seen.add(key)
-            dedup.append(r)
-        all_rows = dedup
-
-        base_cols = ["date", "isin", "security_name", "value"]
-        all_keys = set().union(*[r.keys() for r in all_rows])
-        extra_cols = [c for c in sorted(all_keys) if c not in base_cols + ["_span"]]
-        ordered_cols = base_cols + ["_span"] + extra_cols + ["sr_no"]
-        df = pd.DataFrame(all_rows).reindex(columns=ordered_cols)
-
-        # Excel to bytes
-        out_name = f"extracted_transactions_{RUN_TAG}.xlsx"
+        chunks = doc["chunks"]
+        results = doc["results"]
+        todo = []
+        for ch in chunks:
+            need = [f for f in fields if (ch["idx"], model, f) not in results]
+            if need:
+                todo.append((ch, need))
+
+        n_failed = 0
+        if todo:
+            prog = st.progress(0.0, text=f"Extracting from {len(todo)} of {len(chunks)} chunks…")
+            with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+                futs = {
+                    pool.submit(extract_deal_fields_from_chunk, ch, need, model, openai_key): (ch, need)
+                    for ch, need in todo
+                }
+                for done, fut in enumerate(as_completed(futs), start=1):
+                    ch, need = futs[fut]
+                    try:
+                        found = fut.result()
+                    except Exception:
+                        found = None
+                    if found is None:
+                        n_failed += 1  # leave uncached so the next run retries this chunk
+                    else:
+                        for f in need:
+                            results[(ch["idx"], model, f)] = found.get(f, [])
+                    prog.progress(done / len(todo), text=f"Extracted {done}/{len(todo)} chunks")
+            prog.empty()
+            if n_failed:
+                show_popup_warning(f"LLM extraction failed for {n_failed} chunk(s); re-run to retry them.")
+
+        chunk_results = [
+            (ch, {f: results.get((ch["idx"], model, f), []) for f in fields})
+            for ch in chunks
+        ]
+        merged = reduce_deal_fields(fields, chunk_results)
+        df = pd.DataFrame(merged)
+        evidence = pd.DataFrame([
+            {"chunk": ch["idx"], "pages": f"{ch['page_start']}-{ch['page_end']}",
+             "sections": "; ".join(ch["titles"]), "field": f, "value": v}
+            for ch, found in chunk_results for f, vals in found.items() for v in vals
+        ], columns=["chunk", "pages", "sections", "field", "value"])
+
+        st.success(
+            f"Done. {doc['pages']} pages, {len(chunks)} chunks "
+            f"({len(todo) - n_failed} extracted now, {n_failed} failed, {len(chunks) - len(todo)} served from cache)."
+        )
+        st.dataframe(df, use_container_width=True)
+        n_conflicts = int(df["conflict"].sum()) if len(df) else 0
+        if n_conflicts:
+            show_popup_info(f"{n_conflicts} field(s) had conflicting values across sections; see 'alternatives'.")
+
+        RUN_TAG = datetime.now().strftime("%Y%m%d_%H%M%S")
         try:
             import xlsxwriter  # noqa
             engine = "xlsxwriter"
@@ -890,24 +2484,61 @@ if page == "datarecon":
 
         out_buf = BytesIO()
         with pd.ExcelWriter(out_buf, engine=engine) as writer:
-            df.to_excel(writer, index=False, sheet_name="Extract")
-            if engine == "xlsxwriter":
-                wb = writer.book
-                ws = writer.sheets["Extract"]
-                ws.freeze_panes(1, 0)
-                width_map = {"date": 12, "isin": 20, "security_name": 40, "value": 18, "_span": 60, "sr_no": 8}
-                for i, col in enumerate(df.columns):
-                    ws.set_column(i, i, width_map.get(col, 18))
-                num_fmt = wb.add_format({"num_format": "#,##0"})
-                if "value" in df.columns:
-                    ci = df.columns.get_loc("value")
-                    ws.set_column(ci, ci, 18, num_fmt)
-
-        st.success(f"Done. {len(df)} rows.")
-        st.dataframe(df.head(50), use_container_width=True)
+            df.to_excel(writer, index=False, sheet_name="Fields")
+            evidence.to_excel(writer, index=False, sheet_name="Evidence")
         st.download_button(
             "Download Excel",
             data=out_buf.getvalue(),
-            file_name=out_name,
+            file_name=f"deal_fields_{RUN_TAG}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
+
+# -----------------------------------------------------------
+# HOLDINGS HISTORY PAGE
+# -----------------------------------------------------------
+if page == "history":
+    st.markdown(FORM_PAGE_CSS, unsafe_allow_html=True)
+
+    with st.form("history_form", border=False):
+        st.markdown('<div class="formHead">Holdings History</div>', unsafe_allow_html=True)
+        colA, colB = st.columns([1, 1])
+        with colA:
+            q_isin = st.text_input("ISIN")
+        with colB:
+            q_source = st.text_input("Source file contains")
+        colC, colD, colE = st.columns([1, 1, 1])
+        with colC:
+            q_from = st.date_input("Statement date from", value=None)
+        with colD:
+            q_to = st.date_input("Statement date to", value=None)
+        with colE:
+            q_limit = st.number_input("Max rows", min_value=100, max_value=200000, value=5000, step=1000)
+        search = st.form_submit_button("Search")
+
+    if search:
+        missing = ensure_runtime_dependencies((("pandas", "pandas"),))
+        if missing:
+            show_popup_error("Please install before running: " + ", ".join(sorted(missing)))
+            st.stop()
+        if not os.path.exists(HISTORY_DB_PATH):
+            show_popup_info("No history yet. Run a reconciliation with 'Save rows to holdings history' checked.")
+            st.stop()
+
+        import pandas as pd
+
+        t0 = time.perf_counter()
+        cols, rows = query_history(
+            isin=q_isin.strip() or None, date_from=q_from, date_to=q_to,
+            source_like=q_source.strip() or None, limit=q_limit,
+        )
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        df = pd.DataFrame(rows, columns=cols)
+        st.caption(f"{len(df)} rows in {elapsed_ms:.1f} ms.")
+        st.dataframe(df, use_container_width=True)
+        if len(df):
+            st.download_button(
+                "Download CSV",
+                data=df.to_csv(index=False).encode("utf-8"),
+                file_name=f"holdings_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime="text/csv",
+            )